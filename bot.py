@@ -5,26 +5,147 @@ Enhanced Telegram Video Downloader Bot - الإصدار المحسن
 
 import os
 import asyncio
+import html
 import logging
+import queue
 import sqlite3
-import tempfile
+import threading
+import multiprocessing
 import time
 import re
+import secrets
+import shutil
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple, Any
+from operator import itemgetter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
 # Telegram Bot imports
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, InputMediaDocument
+)
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
 
 # Download engines
 import yt_dlp
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# أقل فترة (بالثواني) بين تحديثين متتاليين لرسالة التقدم
+PROGRESS_INTERVAL = 2.0
+
+# تجميع سجلات التحميل: أقصى انتظار (بالثواني) وأقصى عدد صفوف في المعاملة الواحدة
+LOG_FLUSH_INTERVAL = 0.5
+LOG_BATCH_SIZE = 50
+
+# إعدادات SQLite لكل اتصال (WAL دائم في الملف، والباقي يخص الاتصال نفسه)
+SQLITE_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-20000;
+    PRAGMA busy_timeout=5000;
+"""
+
+# الفترة (بالثواني) بين حفظ عدادات حد المعدل من الذاكرة إلى قاعدة البيانات
+RATE_SNAPSHOT_INTERVAL = 60
+
+# نصوص وأزرار ثابتة تُبنى مرة واحدة عند التحميل
+PROGRESS_TEXT = "{header}\n\n📊 <b>التقدم:</b> {percent}"
+
+# نص الخطأ يُمرر عبر html.escape حتى لا يرفض Telegram الرسالة بسبب < أو &
+ERROR_TEXT = "❌ <b>{title}</b>\n\n{details}"
+
+STATS_TEXT = """
+📊 <b>إحصائياتك الشخصية</b>
+
+• تاريخ الانضمام: {join_date}
+• إجمالي التحميلات: {downloads_count}
+• المحاولات الكلية: {total_attempts}
+• النجح: {completed}
+• معدل النجاح: {success_rate:.1f}%
+"""
+
+WELCOME_TEXT = """
+🎥 <b>مرحباً {first_name}!</b>
+
+🚀 <b>بوت التحميل المتطور</b> - النسخة المحسنة
+
+<b>✅ المميزات:</b>
+• 🎬 تحميل من منصات متعددة
+• 📋 دعم قوائم التشغيل
+• 🎭 ترجمات متعددة
+• 🎯 جودات مختلفة
+• ⚡ تحميل سريع
+
+<b>🔥 طريقة الاستخدام:</b>
+1️⃣ أرسل رابط الفيديو
+2️⃣ اختر الجودة
+3️⃣ احصل على الملف!
+"""
+
+WELCOME_BACK_TEXT = """
+🎥 <b>مرحباً بعودتك {first_name}!</b>
+
+اختر أحد الخيارات:
+"""
+
+HELP_TEXT = """
+📚 <b>دليل الاستخدام</b>
+
+<b>🎯 المنصات المدعومة:</b>
+• YouTube
+• Twitter/X 
+• Instagram
+• TikTok 
+• Facebook
+• وغيرها...
+
+<b>📋 طريقة الاستخدام:</b>
+• أرسل رابط الفيديو
+• اختر نوع التحميل (فيديو/صوت/ترجمة)
+• انتظر حتى يكتمل التحميل
+• استلم الملف
+
+<b>🔧 الأوامر:</b>
+/start - بدء البوت
+/help - المساعدة  
+/stats - إحصائياتك
+/cancel - إلغاء العملية
+"""
+
+HELP_CALLBACK_TEXT = """
+📚 <b>دليل الاستخدام</b>
+
+• أرسل رابط أي فيديو من المنصات المدعومة
+• اختر نوع التحميل المطلوب
+• انتظر حتى اكتمال التحميل
+• استلم الملف عبر البوت
+
+🔧 <b>الأوامر المتاحة:</b>
+/start - بدء استخدام البوت
+/help - عرض المساعدة
+/stats - عرض الإحصائيات
+/cancel - إلغاء العملية الحالية
+"""
+
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 المساعدة", callback_data="help"),
+     InlineKeyboardButton("📊 الإحصائيات", callback_data="stats")]
+])
+
+BACK_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 العودة", callback_data="back_main")]
+])
 
 # Configuration
 class BotConfig:
@@ -32,13 +153,28 @@ class BotConfig:
     def __init__(self):
         self.bot_token = os.getenv('BOT_TOKEN', '')
         admin_str = os.getenv('ADMIN_IDS', '')
-        self.admin_ids = [int(x) for x in admin_str.split(',') if x.strip()]
-        self.max_file_size = int(os.getenv('MAX_FILE_SIZE', 2000))  # MB
+        self.admin_ids = frozenset(int(x) for x in admin_str.split(',') if x.strip())
+        # خادم Bot API محلي اختياري (telegram-bot-api): يرفع حد الإرسال من 50MB إلى 2000MB
+        self.bot_api_url = os.getenv('BOT_API_URL', '').rstrip('/')
+        self.max_file_size = int(os.getenv('MAX_FILE_SIZE', 2000 if self.bot_api_url else 50))  # MB
         self.download_path = os.getenv('DOWNLOAD_PATH', './downloads')
         self.database_path = os.getenv('DATABASE_PATH', './bot.db')
         self.max_concurrent_downloads = int(os.getenv('MAX_CONCURRENT', 5))
+        self.max_concurrent_updates = int(os.getenv('MAX_CONCURRENT_UPDATES', 256))
+        self.max_downloads_per_host = int(os.getenv('MAX_PER_HOST', 2))
+        self.max_concurrent_extractions = int(os.getenv('MAX_EXTRACTIONS', 8))
+        self.info_cache_ttl = int(os.getenv('INFO_CACHE_TTL', 600))  # seconds
+        self.concurrent_fragments = int(os.getenv('YTDLP_CONCURRENT_FRAGS', 8))
+        self.extract_processes = int(os.getenv('EXTRACT_PROCESSES', 0))  # 0 = disabled
+        self.max_sessions = int(os.getenv('MAX_SESSIONS', 2000))
+        self.session_ttl = int(os.getenv('SESSION_TTL', 1800))  # seconds
+        self.file_cache_size = int(os.getenv('FILE_CACHE_MB', 2048))  # MB, 0 = disabled
         self.rate_limit_per_user = int(os.getenv('RATE_LIMIT', 10))  # per hour
         self.enable_playlist_download = os.getenv('ENABLE_PLAYLIST', 'true').lower() == 'true'
+        # وضع webhook اختياري: يُفعّل عند تعيين WEBHOOK_URL وإلا يُستخدم polling
+        self.webhook_url = os.getenv('WEBHOOK_URL', '')
+        self.webhook_port = int(os.getenv('PORT', 8443))
+        self.webhook_secret = os.getenv('WEBHOOK_SECRET', '')
         self.supported_platforms = [
             'youtube.com', 'youtu.be', 'twitter.com', 'x.com',
             'instagram.com', 'facebook.com', 'tiktok.com',
@@ -49,19 +185,77 @@ class BotConfig:
 class DatabaseManager:
     """مدير قاعدة البيانات"""
 
+    # نصوص ثابتة ليعيد sqlite3 استخدام الأوامر المُجهزة من ذاكرته
+    _INSERT_DOWNLOAD_SQL = """
+        INSERT INTO downloads 
+        (user_id, url, title, platform, file_size, download_time, status, error_msg)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    _INCREMENT_DOWNLOADS_SQL = """
+        UPDATE users SET downloads_count = downloads_count + ?
+        WHERE user_id = ?
+    """
+    _UPSERT_USER_STATS_SQL = """
+        INSERT INTO user_stats (user_id, completed, failed, total_bytes)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            completed = completed + excluded.completed,
+            failed = failed + excluded.failed,
+            total_bytes = total_bytes + excluded.total_bytes
+    """
+
     def __init__(self, db_path: str):
         self.db_path = db_path
+
+        # اتصال واحد دائم بدلاً من فتح اتصال جديد في كل استدعاء
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.executescript(SQLITE_PRAGMAS)
+        self._lock = threading.Lock()
+        # الكتابات تُنفذ في خيوط منفصلة وتُسلسل هنا حتى لا تتزاحم على القفل
+        self._write_lock = asyncio.Lock()
+        # سجلات التحميل تنتظر هنا حتى تُكتب على دفعات (None = إشارة التوقف)
+        self._log_queue: asyncio.Queue = asyncio.Queue()
+        # عدادات حد المعدل في الذاكرة: user_id -> (الساعة, عدد الطلبات)
+        self._rate: Dict[int, Tuple[int, int]] = {}
+        self._rate_dirty = set()
+
+        # تتبع أوامر SQL في وضع التصحيح فقط (الاستدعاء لكل أمر مكلف)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self._conn.set_trace_callback(logging.debug)
+
         self.init_database()
+        self._load_rate_limits()
+
+        # اتصال منفصل للقراءة: في وضع WAL لا تنتظر القراءات انتهاء الكتابات
+        self._read_conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._read_conn.executescript(SQLITE_PRAGMAS + "PRAGMA query_only=ON;")
+        self._read_lock = threading.Lock()
+
+    @contextmanager
+    def _transaction(self):
+        """تنفيذ عدة أوامر في معاملة كتابة واحدة"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
 
     def init_database(self):
         """إنشاء جداول قاعدة البيانات"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.executescript("""
+        with self._lock:
+            has_user_stats = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'"
+            ).fetchone() is not None
+
+            self._conn.executescript("""
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
                     username TEXT,
                     first_name TEXT,
-                    joined_date TEXT,
+                    joined_date INTEGER,
                     downloads_count INTEGER DEFAULT 0,
                     is_banned BOOLEAN DEFAULT FALSE
                 );
@@ -73,7 +267,7 @@ class DatabaseManager:
                     title TEXT,
                     platform TEXT,
                     file_size INTEGER,
-                    download_time TEXT,
+                    download_time INTEGER,
                     status TEXT,
                     error_msg TEXT,
                     FOREIGN KEY (user_id) REFERENCES users (user_id)
@@ -84,72 +278,200 @@ class DatabaseManager:
                     hour_start INTEGER,
                     requests_count INTEGER DEFAULT 0
                 );
+
+                -- ملخص تراكمي لكل مستخدم حتى لا تُجمع الإحصائيات من جدول التحميلات
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id INTEGER PRIMARY KEY,
+                    completed INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    total_bytes INTEGER DEFAULT 0
+                );
+
+                -- لا يقرأ أي استعلام من جدول التحميلات: الفهارس تزيد تكلفة الإدراج فقط
+                DROP INDEX IF EXISTS idx_downloads_user_status;
+                DROP INDEX IF EXISTS idx_downloads_user_platform;
+
+                -- تحليل الجداول عند الحاجة فقط بدلاً من ANALYZE كامل في كل تشغيل
+                PRAGMA optimize;
             """)
 
-    def add_user(self, user_id: int, username: str = None, first_name: str = None):
+            # قواعد البيانات القديمة: بناء الملخص من السجل الموجود مرة واحدة
+            if not has_user_stats:
+                self._conn.execute("""
+                    INSERT INTO user_stats (user_id, completed, failed, total_bytes)
+                    SELECT user_id,
+                           SUM(status = 'completed'),
+                           SUM(status = 'failed'),
+                           COALESCE(SUM(CASE WHEN status = 'completed' THEN file_size END), 0)
+                    FROM downloads GROUP BY user_id
+                """)
+
+    def _load_rate_limits(self):
+        """استعادة عدادات الساعة الحالية بعد إعادة التشغيل وحذف ما سبقها"""
+        current_hour = int(time.time()) // 3600
+        with self._lock:
+            self._conn.execute("DELETE FROM rate_limits WHERE hour_start != ?", (current_hour,))
+            rows = self._conn.execute(
+                "SELECT user_id, hour_start, requests_count FROM rate_limits"
+            ).fetchall()
+        self._rate = {user_id: (hour_start, count) for user_id, hour_start, count in rows}
+
+    async def _write(self, func, *args):
+        """تنفيذ عملية كتابة خارج حلقة الأحداث مع تسلسل الكتابات"""
+        async with self._write_lock:
+            return await asyncio.to_thread(func, *args)
+
+    def close(self):
+        """إغلاق الاتصال بقاعدة البيانات"""
+        with self._lock:
+            self._conn.close()
+        with self._read_lock:
+            self._read_conn.close()
+
+    async def add_user(self, user_id: int, username: str = None, first_name: str = None):
         """إضافة مستخدم جديد"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
+        await self._write(self._add_user, user_id, username, first_name)
+
+    def _add_user(self, user_id: int, username: str, first_name: str):
+        with self._lock:
+            self._conn.execute("""
                 INSERT OR IGNORE INTO users 
                 (user_id, username, first_name, joined_date)
                 VALUES (?, ?, ?, ?)
-            """, (user_id, username, first_name, datetime.now().isoformat()))
-
-    def check_rate_limit(self, user_id: int, limit: int) -> bool:
+            """, (user_id, username, first_name, int(time.time())))
+
+    async def get_user_stats(self, user_id: int) -> Tuple:
+        """جلب إحصائيات المستخدم خارج حلقة الأحداث"""
+        return await asyncio.to_thread(self._get_user_stats, user_id)
+
+    def _get_user_stats(self, user_id: int) -> Tuple:
+        # استعلام واحد يعيد صفاً دائماً حتى لو غاب المستخدم عن أحد الجدولين:
+        # (downloads_count, joined_date, total_attempts, completed) والقيم الغائبة None
+        with self._read_lock:
+            return self._read_conn.execute("""
+                SELECT u.downloads_count, u.joined_date, s.completed + s.failed, s.completed
+                FROM (SELECT ? AS user_id) AS k
+                LEFT JOIN users AS u ON u.user_id = k.user_id
+                LEFT JOIN user_stats AS s ON s.user_id = k.user_id
+            """, (user_id,)).fetchone()
+
+    async def check_rate_limit(self, user_id: int, limit: int) -> bool:
         """فحص حد المعدل للمستخدم"""
-        current_hour = int(time.time() // 3600)
+        current_hour = int(time.time()) // 3600
+        hour_start, count = self._rate.get(user_id, (current_hour, 0))
+        if hour_start != current_hour:
+            count = 0
+        if count >= limit:
+            return False
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("""
-                SELECT hour_start, requests_count 
-                FROM rate_limits WHERE user_id = ?
-            """, (user_id,))
+        self._rate[user_id] = (current_hour, count + 1)
+        self._rate_dirty.add(user_id)
+        return True
+
+    async def run_rate_snapshot(self):
+        """حفظ عدادات حد المعدل دورياً"""
+        while True:
+            await asyncio.sleep(RATE_SNAPSHOT_INTERVAL)
+            try:
+                await self.save_rate_limits()
+            except Exception as e:
+                logging.error(f"Error saving rate limits: {e}")
+
+    async def save_rate_limits(self):
+        """كتابة العدادات المتغيرة منذ آخر حفظ وحذف عدادات الساعات السابقة"""
+        current_hour = int(time.time()) // 3600
+        stale = [uid for uid, (hour_start, _) in self._rate.items() if hour_start != current_hour]
+        for uid in stale:
+            del self._rate[uid]
+
+        rows = [(uid, *self._rate[uid]) for uid in self._rate_dirty if uid in self._rate]
+        self._rate_dirty = set()
+        if rows:
+            await self._write(self._save_rate_limits, rows)
+
+    def _save_rate_limits(self, rows: List[Tuple[int, int, int]]):
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO rate_limits (user_id, hour_start, requests_count)
+                VALUES (?, ?, ?)
+            """, rows)
+
+    async def log_download(self, user_id: int, url: str, title: str, 
+                           platform: str, file_size: int, status: str, error_msg: str = None):
+        """تسجيل عملية التحميل (يُكتب لاحقاً ضمن دفعة)"""
+        self._log_queue.put_nowait(
+            (user_id, url, title, platform, file_size,
+             int(time.time()), status, error_msg)
+        )
 
-            result = cursor.fetchone()
+    async def run_log_writer(self):
+        """كتابة سجلات التحميل المنتظرة على دفعات حتى استلام إشارة التوقف"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._log_queue.get()]
+            deadline = loop.time() + LOG_FLUSH_INTERVAL
+            while batch[-1] is not None and len(batch) < LOG_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._log_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            stop = batch[-1] is None
+            rows = batch[:-1] if stop else batch
+            if rows:
+                try:
+                    await self.log_downloads_bulk(rows)
+                except Exception as e:
+                    logging.error(f"Error writing download logs: {e}")
+            if stop:
+                return
 
-            if not result:
-                conn.execute("""
-                    INSERT INTO rate_limits (user_id, hour_start, requests_count)
-                    VALUES (?, ?, 1)
-                """, (user_id, current_hour))
-                return True
+    def stop_log_writer(self):
+        """إيقاف كاتب السجلات بعد كتابة ما تبقى في الطابور"""
+        self._log_queue.put_nowait(None)
 
-            hour_start, requests_count = result
+    async def log_downloads_bulk(self, rows: List[Tuple]):
+        """تسجيل عدة عمليات تحميل في معاملة واحدة"""
+        await self._write(self._log_downloads_bulk, rows)
 
-            if hour_start != current_hour:
-                conn.execute("""
-                    UPDATE rate_limits 
-                    SET hour_start = ?, requests_count = 1
-                    WHERE user_id = ?
-                """, (current_hour, user_id))
-                return True
+    def _log_downloads_bulk(self, rows: List[Tuple]):
+        # تجميع الصفوف لكل مستخدم: تحديث واحد لكل مستخدم بدلاً من واحد لكل صف
+        completed, failed, total_bytes = Counter(), Counter(), Counter()
+        for row in rows:
+            user_id, status = row[0], row[6]
+            if status == 'completed':
+                completed[user_id] += 1
+                total_bytes[user_id] += row[4] or 0
+            elif status == 'failed':
+                failed[user_id] += 1
+
+        stats = [
+            (user_id, completed[user_id], failed[user_id], total_bytes[user_id])
+            for user_id in {row[0] for row in rows}
+        ]
+        with self._transaction() as conn:
+            conn.executemany(self._INSERT_DOWNLOAD_SQL, rows)
+            if completed:
+                conn.executemany(
+                    self._INCREMENT_DOWNLOADS_SQL,
+                    [(count, user_id) for user_id, count in completed.items()]
+                )
+            conn.executemany(self._UPSERT_USER_STATS_SQL, stats)
 
-            if requests_count >= limit:
-                return False
-
-            conn.execute("""
-                UPDATE rate_limits 
-                SET requests_count = requests_count + 1
-                WHERE user_id = ?
-            """, (user_id,))
-            return True
-
-    def log_download(self, user_id: int, url: str, title: str, 
-                     platform: str, file_size: int, status: str, error_msg: str = None):
-        """تسجيل عملية التحميل"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT INTO downloads 
-                (user_id, url, title, platform, file_size, download_time, status, error_msg)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (user_id, url, title, platform, file_size, 
-                  datetime.now().isoformat(), status, error_msg))
+# نسخة YoutubeDL الخاصة بكل عملية في مجمع الاستخراج
+_process_ydl: Optional[yt_dlp.YoutubeDL] = None
 
-            if status == 'completed':
-                conn.execute("""
-                    UPDATE users SET downloads_count = downloads_count + 1
-                    WHERE user_id = ?
-                """, (user_id,))
+def _extract_info_worker(url: str, opts: Dict) -> Optional[Dict]:
+    """استخراج معلومات الفيديو داخل عملية منفصلة بعيداً عن قفل GIL"""
+    global _process_ydl
+    if _process_ydl is None:
+        _process_ydl = yt_dlp.YoutubeDL(opts)
+    info = _process_ydl.extract_info(url, download=False)
+    # إزالة الكائنات غير القابلة للنقل بين العمليات
+    return _process_ydl.sanitize_info(info) if info else info
 
 # محرك التحميل المتقدم
 class EnhancedDownloader:
@@ -157,119 +479,279 @@ class EnhancedDownloader:
 
     def __init__(self, config: BotConfig):
         self.config = config
-        self.executor = ThreadPoolExecutor(max_workers=config.max_concurrent_downloads)
+        # حدود التحميل المتزامن: حد عام وحد لكل منصة لتجنب الحظر
+        self._download_semaphore = asyncio.Semaphore(config.max_concurrent_downloads)
+        self._host_semaphores = defaultdict(
+            lambda: asyncio.Semaphore(config.max_downloads_per_host)
+        )
+        # حد مستقل لاستخراج المعلومات حتى لا ينتظر خلف التحميلات الطويلة ولا يستهلك كل الخيوط
+        self._info_semaphore = asyncio.Semaphore(config.max_concurrent_extractions)
+
+        # ذاكرة مؤقتة لمعلومات الفيديو: url -> (وقت الاستخراج, info)
+        self._info_cache: Dict[str, Tuple[float, Dict]] = {}
+        self._info_pending: Dict[str, asyncio.Future] = {}
+
+        # نسخ YoutubeDL لكل خيط (YoutubeDL غير آمن للاستخدام من عدة خيوط)
+        self._local = threading.local()
+
+        # مسارات الحفظ تُحسب مرة واحدة
+        self._subs_dir = os.path.join(config.download_path, 'subs')
+        # المعرف في الاسم يمنع تداخل فيديوهين بنفس العنوان في ذاكرة الملفات
+        self._outtmpl_video = os.path.join(config.download_path, '%(title).50s [%(id)s].%(ext)s')
+        # الصوت باسم مستقل: على المنصات ذات الصيغ المدمجة فقط يختار bestaudio/best نفس ملف
+        # الفيديو، فيحذفه FFmpegExtractAudio بعد التحويل
+        self._outtmpl_audio = os.path.join(config.download_path, '%(title).50s [%(id)s].audio.%(ext)s')
 
         # إعدادات yt-dlp محدثة
         self.ydl_opts_base = {
-            'format': 'best[height<=720]',
-            'outtmpl': os.path.join(config.download_path, '%(title).50s.%(ext)s'),
-            'writethumbnail': True,
+            # تفضيل مسارات mp4/m4a المنفصلة (دمج بدون إعادة ترميز) ثم الصيغ المدمجة مسبقاً
+            'format': 'bv*[height<=720][ext=mp4]+ba[ext=m4a]/b[height<=720][ext=mp4]/b[height<=720]',
+            'merge_output_format': 'mp4',
+            'outtmpl': self._outtmpl_video,
             'ignoreerrors': False,
             'no_warnings': False,
             'quiet': True,
             'extract_flat': False,
+            # تحميل أجزاء HLS/DASH بالتوازي
+            'concurrent_fragment_downloads': config.concurrent_fragments,
+            # إعادة محاولة محدودة حتى لا يحجز تحميل متعثر مكاناً لفترة طويلة
+            'retries': 3,
+            'fragment_retries': 3,
+            # كتل قراءة/كتابة 64KiB بدلاً من 1KiB، وطلبات HTTP مجزأة بحجم 10MiB
+            'buffersize': 65536,
+            'http_chunk_size': 10485760,
         }
+        self._ydl_opts_audio = {
+            **self.ydl_opts_base,
+            'outtmpl': self._outtmpl_audio,
+            'format': 'bestaudio/best',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }],
+        }
+        # استخراج المعلومات لا يحتاج إعدادات الحفظ أو الصور المصغرة
+        self._ydl_opts_info = {
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+            # قوائم التشغيل: جلب المعرفات والعناوين فقط دون استخراج كل فيديو
+            'extract_flat': 'in_playlist',
+        }
+
+        # خيوط مخصصة لاستخراج المعلومات لا تتشارك مع خيوط التحميل
+        self._info_executor = ThreadPoolExecutor(
+            max_workers=config.max_concurrent_extractions,
+            thread_name_prefix='ytdlp-info'
+        )
+        # مجمع عمليات اختياري لاستخراج المعلومات (فك التشفير يستهلك المعالج)
+        # spawn بدلاً من fork: نسخ عملية فيها خيوط تعمل قد يرث أقفالاً مقفلة
+        self._extract_pool = (
+            ProcessPoolExecutor(
+                max_workers=config.extract_processes,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            if config.extract_processes > 0 else None
+        )
+
+    def close(self):
+        """إيقاف خيوط وعمليات الاستخراج"""
+        self._info_executor.shutdown(wait=False, cancel_futures=True)
+        if self._extract_pool is not None:
+            self._extract_pool.shutdown(wait=False, cancel_futures=True)
+
+    @asynccontextmanager
+    async def _download_slot(self, platform: str):
+        """حجز مكان للتحميل ضمن الحد العام وحد المنصة"""
+        async with self._host_semaphores[platform], self._download_semaphore:
+            yield
+
+    def _info_ydl(self) -> yt_dlp.YoutubeDL:
+        """نسخة YoutubeDL خاصة بالخيط الحالي لاستخراج المعلومات"""
+        ydl = getattr(self._local, 'info_ydl', None)
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(self._ydl_opts_info)
+            self._local.info_ydl = ydl
+        return ydl
+
+    def _download_ydl(self, key: Tuple, ydl_opts: Dict) -> Tuple[yt_dlp.YoutubeDL, list]:
+        """نسخة YoutubeDL للتحميل خاصة بالخيط الحالي لكل مجموعة إعدادات، مع خانة دالة التقدم"""
+        ydls = getattr(self._local, 'download_ydls', None)
+        if ydls is None:
+            ydls = self._local.download_ydls = {}
+        entry = ydls.get(key)
+        if entry is None:
+            # دالة تقدم ثابتة تستدعي دالة التحميل الحالي، لأن النسخة تُعاد لعدة تحميلات؛
+            # قد تُستدعى من خيوط الأجزاء المتوازية لذلك تُخزن في قائمة لا في threading.local
+            hook_slot = [None]
+
+            def hook(d, hook_slot=hook_slot):
+                if hook_slot[0] is not None:
+                    hook_slot[0](d)
+
+            entry = ydls[key] = (yt_dlp.YoutubeDL({**ydl_opts, 'progress_hooks': [hook]}), hook_slot)
+        return entry
+
+    def _evict_expired_info(self):
+        """حذف المعلومات المنتهية صلاحيتها من الذاكرة المؤقتة"""
+        deadline = time.monotonic() - self.config.info_cache_ttl
+        expired = [url for url, (stamp, _) in self._info_cache.items() if stamp < deadline]
+        for url in expired:
+            del self._info_cache[url]
+
+    def _extract_info_sync(self, url: str) -> Optional[Dict]:
+        return self._info_ydl().extract_info(url, download=False)
 
     async def get_video_info(self, url: str) -> Optional[Dict]:
         """الحصول على معلومات الفيديو"""
+        cached = self._info_cache.get(url)
+        if cached and time.monotonic() - cached[0] < self.config.info_cache_ttl:
+            return cached[1]
+
+        # طلبات متزامنة لنفس الرابط تنتظر استخراجاً واحداً بدلاً من تكراره
+        task = self._info_pending.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_video_info(url))
+            self._info_pending[url] = task
+            task.add_done_callback(lambda _: self._info_pending.pop(url, None))
+        # shield: إلغاء أحد المنتظرين لا يلغي الاستخراج على الآخرين
+        return await asyncio.shield(task)
+
+    async def _fetch_video_info(self, url: str) -> Optional[Dict]:
         try:
-            loop = asyncio.get_event_loop()
-
-            def extract_info():
-                ydl_opts = {
-                    **self.ydl_opts_base,
-                    'skip_download': True,
-                }
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(url, download=False)
-
-            info = await loop.run_in_executor(self.executor, extract_info)
+            loop = asyncio.get_running_loop()
+            async with self._info_semaphore:
+                if self._extract_pool is not None:
+                    info = await loop.run_in_executor(
+                        self._extract_pool, _extract_info_worker, url, self._ydl_opts_info
+                    )
+                else:
+                    info = await loop.run_in_executor(
+                        self._info_executor, self._extract_info_sync, url
+                    )
+            if info:
+                self._evict_expired_info()
+                self._info_cache[url] = (time.monotonic(), info)
             return info
 
         except Exception as e:
             logging.error(f"Error extracting info: {e}")
             return None
 
-    async def get_available_formats(self, url: str) -> List[Dict]:
-        """الحصول على الصيغ المتاحة للتحميل"""
-        info = await self.get_video_info(url)
-        if not info:
-            return []
-
+    @staticmethod
+    def get_available_formats(info: Dict) -> List[Dict]:
+        """استخراج الصيغ المدمجة (صوت + صورة) من معلومات الفيديو المستخرجة مسبقاً"""
         formats = []
         for fmt in info.get('formats', []):
             if fmt.get('vcodec') != 'none' and fmt.get('acodec') != 'none':
-                quality = fmt.get('height', 0)
+                quality = fmt.get('height') or 0
                 size_mb = fmt.get('filesize', 0) / (1024 * 1024) if fmt.get('filesize') else 0
 
                 formats.append({
                     'format_id': fmt['format_id'],
                     'ext': fmt['ext'],
                     'quality': f"{quality}p" if quality else "Unknown",
+                    'height': quality,
                     'size_mb': round(size_mb, 1),
                     'note': fmt.get('format_note', ''),
                     'filesize': fmt.get('filesize', 0)
                 })
 
-        formats.sort(key=lambda x: int(x['quality'].replace('p', '')) if x['quality'] != 'Unknown' else 0, reverse=True)
+        formats.sort(key=itemgetter('height'), reverse=True)
         return formats
 
-    async def download_video(self, url: str, format_id: str = None, 
-                           progress_callback=None) -> Tuple[bool, str, Dict]:
+    def _download_sync(self, key: Tuple, ydl_opts: Dict, url: str,
+                       cached_info: Optional[Dict], progress_callback) -> Tuple[str, Dict]:
+        ydl, hook_slot = self._download_ydl(key, ydl_opts)
+        hook_slot[0] = progress_callback
+        try:
+            info_dict = None
+            # المعلومات المخزنة تصلح لفيديو منفرد فقط: sanitize_info تحذف entries من قوائم التشغيل
+            if cached_info is not None and cached_info.get('_type', 'video') == 'video':
+                try:
+                    # إعادة استخدام المعلومات المستخرجة مسبقاً دون تشغيل المستخرج مرة أخرى؛
+                    # sanitize_info تضيف epoch و_type و_version إلى القاموس الممرر لذا تُعطى نسخة،
+                    # وتعيد قاموساً خالياً من نتائج اختيار الصيغة السابقة
+                    info_dict = ydl.process_ie_result(
+                        ydl.sanitize_info(dict(cached_info), remove_private_keys=True), download=True
+                    )
+                except yt_dlp.utils.DownloadError as e:
+                    # روابط الصيغ الموقعة قد تنتهي صلاحيتها: إعادة الاستخراج مرة واحدة
+                    logging.warning(f"Cached info download failed, re-extracting: {e}")
+            if info_dict is None:
+                info_dict = ydl.extract_info(url, download=True)
+            # المسار النهائي بعد المعالجة اللاحقة (مثل التحويل إلى mp3) إن توفر
+            downloads = info_dict.get('requested_downloads') or [{}]
+            return downloads[0].get('filepath') or ydl.prepare_filename(info_dict), info_dict
+        finally:
+            hook_slot[0] = None
+
+    async def download_video(self, url: str, platform: str, format_id: str = None, 
+                           progress_callback=None,
+                           cached_info: Optional[Dict] = None) -> Tuple[bool, str, Dict]:
         """تحميل الفيديو مع إظهار التقدم"""
         try:
-            ydl_opts = {**self.ydl_opts_base}
+            ydl_opts = self.ydl_opts_base
             if format_id:
-                ydl_opts['format'] = format_id
-
-            loop = asyncio.get_event_loop()
-
-            def download():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info_dict = ydl.extract_info(url, download=True)
-                    filename = ydl.prepare_filename(info_dict)
-                    return True, filename, info_dict
+                ydl_opts = {**ydl_opts, 'format': format_id}
 
-            success, filename, info = await loop.run_in_executor(self.executor, download)
-            return success, filename, info
+            async with self._download_slot(platform):
+                filename, info = await asyncio.to_thread(
+                    self._download_sync, ('video', format_id), ydl_opts, url,
+                    cached_info, progress_callback
+                )
+            return True, filename, info
 
         except Exception as e:
             logging.error(f"Download error: {e}")
             return False, str(e), {}
 
-    async def download_audio_only(self, url: str, progress_callback=None) -> Tuple[bool, str, Dict]:
+    async def download_audio_only(self, url: str, platform: str, progress_callback=None,
+                                  cached_info: Optional[Dict] = None) -> Tuple[bool, str, Dict]:
         """تحميل الصوت فقط"""
         try:
-            ydl_opts = {
-                **self.ydl_opts_base,
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            }
-
-            loop = asyncio.get_event_loop()
-
-            def download():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info_dict = ydl.extract_info(url, download=True)
-                    filename = ydl.prepare_filename(info_dict).replace('.webm', '.mp3').replace('.m4a', '.mp3')
-                    return True, filename, info_dict
-
-            success, filename, info = await loop.run_in_executor(self.executor, download)
-            return success, filename, info
+            async with self._download_slot(platform):
+                filename, info = await asyncio.to_thread(
+                    self._download_sync, ('audio',), self._ydl_opts_audio, url,
+                    cached_info, progress_callback
+                )
+            return True, filename, info
 
         except Exception as e:
             logging.error(f"Audio download error: {e}")
             return False, str(e), {}
 
-    async def extract_subtitles(self, url: str, languages: List[str] = None) -> Dict[str, str]:
+    def _extract_subtitles_sync(self, ydl_opts: Dict, url: str, languages: List[str]) -> Dict[str, str]:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=True)
+
+            subtitle_files = {}
+            if 'requested_subtitles' in info and info['requested_subtitles']:
+                for lang, sub_info in info['requested_subtitles'].items():
+                    if sub_info and os.path.exists(sub_info.get('filepath', '')):
+                        subtitle_files[lang] = sub_info['filepath']
+
+            # إذا لم يتم العثور على ترجمات مطلوبة، ابحث عن أي ترجمات متاحة
+            if not subtitle_files and 'subtitles' in info:
+                for lang, subs in info['subtitles'].items():
+                    if subs and lang in languages:
+                        # حاول إنشاء مسار ملف الترجمة
+                        base_path = f"{os.path.splitext(ydl.prepare_filename(info))[0]}.{lang}.srt"
+                        if os.path.exists(base_path):
+                            subtitle_files[lang] = base_path
+
+            return subtitle_files
+
+    async def extract_subtitles(self, url: str, platform: str,
+                                languages: List[str] = None) -> Dict[str, str]:
         """استخراج ملفات الترجمة - الإصدار المحسن"""
         if languages is None:
             languages = ['ar', 'en']
 
+        # مجلد مستقل لكل طلب: طلبان لنفس الفيديو لا يكتبان على ملفات بعضهما ولا يحذفانها
+        request_dir = os.path.join(self._subs_dir, secrets.token_hex(8))
+        subtitle_files = {}
         try:
             ydl_opts = {
                 'writesubtitles': True,
@@ -277,39 +759,23 @@ class EnhancedDownloader:
                 'subtitleslangs': languages,
                 'subtitlesformat': 'srt',
                 'skip_download': True,
-                'outtmpl': os.path.join(self.config.download_path, 'subs', '%(title).50s.%(ext)s'),
+                'outtmpl': os.path.join(request_dir, '%(title).50s.%(ext)s'),
                 'quiet': True,
             }
 
-            loop = asyncio.get_event_loop()
-
-            def extract():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    
-                    subtitle_files = {}
-                    if 'requested_subtitles' in info and info['requested_subtitles']:
-                        for lang, sub_info in info['requested_subtitles'].items():
-                            if sub_info and os.path.exists(sub_info.get('filepath', '')):
-                                subtitle_files[lang] = sub_info['filepath']
-                    
-                    # إذا لم يتم العثور على ترجمات مطلوبة، ابحث عن أي ترجمات متاحة
-                    if not subtitle_files and 'subtitles' in info:
-                        for lang, subs in info['subtitles'].items():
-                            if subs and lang in languages:
-                                # حاول إنشاء مسار ملف الترجمة
-                                base_path = os.path.join(self.config.download_path, 'subs', f"{info['title']}.{lang}.srt")
-                                if os.path.exists(base_path):
-                                    subtitle_files[lang] = base_path
-                    
-                    return subtitle_files
-
-            subtitle_files = await loop.run_in_executor(self.executor, extract)
+            async with self._download_slot(platform):
+                subtitle_files = await asyncio.to_thread(
+                    self._extract_subtitles_sync, ydl_opts, url, languages
+                )
             return subtitle_files
 
         except Exception as e:
             logging.error(f"Subtitle extraction error: {e}")
             return {}
+        finally:
+            # عند وجود ملفات يحذف البوت المجلد بعد إرسالها
+            if not subtitle_files:
+                await asyncio.to_thread(shutil.rmtree, request_dir, True)
 
 class TelegramBot:
     """البوت الرئيسي مع واجهة متطورة"""
@@ -322,110 +788,238 @@ class TelegramBot:
         os.makedirs(config.download_path, exist_ok=True)
         os.makedirs(os.path.join(config.download_path, 'subs'), exist_ok=True)
 
-        self.user_states = {}
+        # جلسات الروابط مفهرسة برمز الأزرار (الأقدم أولاً)
+        self.sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        self._background_tasks = set()
+        # قفل لكل محادثة مع عدد المنتظرين عليه (يُحذف عند انتهاء آخر تحميل)
+        self._chat_locks: Dict[int, list] = {}
+        # ذاكرة ملفات LRU على القرص: (النوع، المستخرج، المعرف) -> (المسار، الحجم)
+        self._file_cache: "OrderedDict[Tuple[str, str, str], Tuple[str, int]]" = OrderedDict()
+        self._file_cache_bytes = 0
+        # التحميلات الجارية حسب مفتاح الملف، وعدد من يستخدم كل ملف محمل حالياً
+        self._downloads_pending: Dict[Tuple[str, str, str], asyncio.Task] = {}
+        self._file_users: Counter = Counter()
+        self._log_writer: Optional[asyncio.Task] = None
+        self._rate_snapshot: Optional[asyncio.Task] = None
+
+        # مطابقة النطاقات المدعومة بتعبير واحد مُجهز مسبقاً
+        self._platform_re = re.compile(
+            r'(?:^|\.)(' +
+            '|'.join(re.escape(p) for p in config.supported_platforms) +
+            r')$'
+        )
 
     def is_admin(self, user_id: int) -> bool:
         """فحص صلاحيات الإدارة"""
         return user_id in self.config.admin_ids
 
-    def is_supported_platform(self, url: str) -> bool:
-        """فحص دعم المنصة"""
+    @staticmethod
+    def _file_size(path: str) -> int:
+        """حجم الملف بالبايت أو صفر إذا لم يكن موجوداً (استدعاء stat واحد)"""
         try:
-            domain = urlparse(url).netloc.lower()
-            return any(platform in domain for platform in self.config.supported_platforms)
-        except:
-            return False
-
-    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """أمر البداية"""
-        user = update.effective_user
-        self.db.add_user(user.id, user.username, user.first_name)
+            return os.stat(path).st_size
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _format_date(value) -> str:
+        """عرض تاريخ مخزن كثوانٍ منذ epoch (أو كنص ISO في قواعد البيانات القديمة)"""
+        if isinstance(value, str) and not value.isdigit():
+            return datetime.fromisoformat(value).strftime('%Y-%m-%d')
+        return datetime.fromtimestamp(int(value)).strftime('%Y-%m-%d')
+
+    @staticmethod
+    def _remove_file(path: str):
+        """حذف ملف أو مجلد مؤقت مع تجاهل المحذوف مسبقاً"""
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Cleanup error for {path}: {e}")
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    async def _send_document(self, message, path: str, caption: str):
+        """إرسال ملف مع قراءته في خيط منفصل حتى لا تتوقف حلقة الأحداث"""
+        if self.config.bot_api_url:
+            # الخادم المحلي يقرأ الملف من القرص مباشرة عبر مساره دون رفعه
+            await message.reply_document(path, caption=caption)
+            return
+        # مكتبة Telegram تقرأ الملف كاملاً في الذاكرة على أي حال، لكن بشكل متزامن
+        data = await asyncio.to_thread(self._read_file, path)
+        await message.reply_document(
+            InputFile(data, filename=os.path.basename(path)),
+            caption=caption
+        )
 
-        welcome_text = f"""
-🎥 <b>مرحباً {user.first_name}!</b>
+    async def _send_documents(self, message, documents: List[Tuple[str, str]]):
+        """إرسال عدة ملفات (المسار، الوصف) كمجموعة وسائط واحدة لكل 10 ملفات"""
+        if len(documents) == 1:
+            await self._send_document(message, *documents[0])
+            return
 
-🚀 <b>بوت التحميل المتطور</b> - النسخة المحسنة
+        if self.config.bot_api_url:
+            # InputMediaDocument يتجاهل local_mode ويقرأ المسار المحلي بنفسه،
+            # لذا يُمرر رابط file:// الذي يقرؤه الخادم المحلي من القرص
+            contents = [Path(path).absolute().as_uri() for path, _ in documents]
+        else:
+            contents = await asyncio.gather(*(
+                asyncio.to_thread(self._read_file, path) for path, _ in documents
+            ))
+        media = [
+            InputMediaDocument(data, caption=caption, filename=os.path.basename(path))
+            for (path, caption), data in zip(documents, contents)
+        ]
+        for start in range(0, len(media), 10):
+            await message.reply_media_group(media=media[start:start + 10])
 
-<b>✅ المميزات:</b>
-• 🎬 تحميل من منصات متعددة
-• 📋 دعم قوائم التشغيل
-• 🎭 ترجمات متعددة
-• 🎯 جودات مختلفة
-• ⚡ تحميل سريع
+    @staticmethod
+    def _file_cache_key(kind: str, info: Dict) -> Optional[Tuple[str, str, str]]:
+        """مفتاح الملف في الذاكرة المؤقتة حسب نوع التحميل ومعرف الفيديو"""
+        if not info.get('id'):
+            return None
+        return kind, info.get('extractor_key', ''), info['id']
 
-<b>🔥 طريقة الاستخدام:</b>
-1️⃣ أرسل رابط الفيديو
-2️⃣ اختر الجودة
-3️⃣ احصل على الملف!
-        """
+    async def _cached_file(self, key) -> Optional[str]:
+        """مسار ملف محمل مسبقاً لنفس الفيديو إن كان ما زال في الذاكرة المؤقتة وعلى القرص"""
+        entry = self._file_cache.get(key) if key else None
+        if entry is None:
+            return None
+        size = await asyncio.to_thread(self._file_size, entry[0])
+        # قد يُحذف المدخل أثناء فحص الملف
+        if self._file_cache.get(key) is not entry:
+            return None
+        if not size:
+            # الملف حُذف أو أصبح فارغاً: يُزال من الذاكرة ويُعاد التحميل
+            del self._file_cache[key]
+            self._file_cache_bytes -= entry[1]
+            return None
+        self._file_cache.move_to_end(key)
+        return entry[0]
+
+    def _keep_file(self, key, path: str, size: int) -> bool:
+        """الاحتفاظ بالملف لإعادة استخدامه مع حذف الأقدم عند تجاوز الحجم المحدد"""
+        limit = self.config.file_cache_size * 1024 * 1024
+        if key in self._file_cache:
+            if size:
+                self._file_cache.move_to_end(key)
+                return True
+            # الملف المخزن لم يعد موجوداً على القرص
+            self._file_cache_bytes -= self._file_cache.pop(key)[1]
+            return False
+        if key is None or not size or size > limit:
+            return False
+        self._file_cache[key] = (path, size)
+        self._file_cache_bytes += size
+        while self._file_cache_bytes > limit:
+            _, (old_path, old_size) = self._file_cache.popitem(last=False)
+            self._file_cache_bytes -= old_size
+            # ملف ما زال قيد الإرسال يُترك لآخر من يستخدمه
+            if old_path not in self._file_users:
+                self._schedule_cleanup(old_path)
+        return True
+
+    async def _shared_download(self, key, download):
+        """تحميل واحد للفيديو مهما تعدد من يطلبه في نفس الوقت"""
+        if key is None:
+            return await download()
+        task = self._downloads_pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(download())
+            self._downloads_pending[key] = task
+            task.add_done_callback(lambda _: self._downloads_pending.pop(key, None))
+        # shield: إلغاء أحد المنتظرين لا يلغي التحميل على الآخرين
+        return await asyncio.shield(task)
+
+    def _release_file(self, path: str) -> bool:
+        """إنهاء استخدام الملف؛ True إذا كان هذا آخر من يستخدمه"""
+        self._file_users[path] -= 1
+        if self._file_users[path] > 0:
+            return False
+        del self._file_users[path]
+        return True
+
+    def _schedule_cleanup(self, *paths: str):
+        """حذف الملفات في الخلفية دون تأخير الرد على المستخدم"""
+        for path in paths:
+            task = asyncio.create_task(asyncio.to_thread(self._remove_file, path))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+    @staticmethod
+    def _url_domain(url: str) -> str:
+        """استخراج نطاق الرابط مرة واحدة (نص فارغ إن لم يكن رابطاً صالحاً)"""
+        try:
+            parsed = urlparse(url)
+            # المخطط قد يُكتب بأحرف كبيرة (HTTPS://) من لوحات مفاتيح الجوال
+            if parsed.scheme.lower() not in ('http', 'https'):
+                return ''
+            return parsed.hostname or ''
+        except ValueError:
+            return ''
+
+    def _platform_key(self, domain: str, info: Dict) -> str:
+        """مفتاح حد التحميل للمنصة: المستخرج نفسه لكل أسماء النطاق (youtu.be وm.youtube.com...)"""
+        extractor = info.get('extractor_key')
+        if extractor:
+            return extractor
+        match = self._platform_re.search(domain)
+        return match.group(1) if match else domain
+
+    def is_supported_platform(self, domain: str) -> bool:
+        """فحص دعم المنصة"""
+        return bool(domain) and self._platform_re.search(domain) is not None
 
-        keyboard = [
-            [InlineKeyboardButton("📋 المساعدة", callback_data="help"),
-             InlineKeyboardButton("📊 الإحصائيات", callback_data="stats")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """أمر البداية"""
+        user = update.effective_user
+        await self.db.add_user(user.id, user.username, user.first_name)
 
         await update.message.reply_text(
-            welcome_text,
+            WELCOME_TEXT.format(first_name=html.escape(user.first_name)),
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=MAIN_MENU_KEYBOARD
         )
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """أمر المساعدة"""
-        help_text = """
-📚 <b>دليل الاستخدام</b>
-
-<b>🎯 المنصات المدعومة:</b>
-• YouTube
-• Twitter/X 
-• Instagram
-• TikTok 
-• Facebook
-• وغيرها...
-
-<b>📋 طريقة الاستخدام:</b>
-• أرسل رابط الفيديو
-• اختر نوع التحميل (فيديو/صوت/ترجمة)
-• انتظر حتى يكتمل التحميل
-• استلم الملف
-
-<b>🔧 الأوامر:</b>
-/start - بدء البوت
-/help - المساعدة  
-/stats - إحصائياتك
-/cancel - إلغاء العملية
-        """
-
-        keyboard = [
-            [InlineKeyboardButton("🔙 العودة", callback_data="back_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
         await update.message.reply_text(
-            help_text,
+            HELP_TEXT,
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=BACK_KEYBOARD
+        )
+
+    async def handle_unsupported(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """الرد على النصوص والروابط غير المدعومة بقائمة المنصات المدعومة"""
+        await update.message.reply_text(
+            "❌ <b>منصة غير مدعومة</b>\n\n"
+            "المنصات المدعومة:\n" + 
+            "\n".join(f"• {platform}" for platform in self.config.supported_platforms),
+            parse_mode=ParseMode.HTML
         )
 
     async def handle_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالجة الروابط المرسلة"""
         user_id = update.effective_user.id
         url = update.message.text.strip()
+        domain = self._url_domain(url)
 
-        if not self.db.check_rate_limit(user_id, self.config.rate_limit_per_user):
-            await update.message.reply_text(
-                "⏰ <b>تم تجاوز الحد المسموح!</b>\n\n"
-                f"يمكنك تحميل حتى {self.config.rate_limit_per_user} ملفات في الساعة.",
-                parse_mode=ParseMode.HTML
-            )
+        if not self.is_supported_platform(domain):
+            await self.handle_unsupported(update, context)
             return
 
-        if not self.is_supported_platform(url):
+        # فحص المعدل بعد التحقق من المنصة حتى لا تستهلك الروابط المرفوضة رصيد المستخدم
+        if not await self.db.check_rate_limit(user_id, self.config.rate_limit_per_user):
             await update.message.reply_text(
-                "❌ <b>منصة غير مدعومة</b>\n\n"
-                "المنصات المدعومة:\n" + 
-                "\n".join(f"• {platform}" for platform in self.config.supported_platforms),
+                "⏰ <b>تم تجاوز الحد المسموح!</b>\n\n"
+                f"يمكنك تحميل حتى {self.config.rate_limit_per_user} ملفات في الساعة.",
                 parse_mode=ParseMode.HTML
             )
             return
@@ -449,7 +1043,7 @@ class TelegramBot:
                 await self.handle_playlist(update, info, loading_msg)
                 return
 
-            await self.show_video_options(update, url, info, loading_msg)
+            await self.show_video_options(update, url, domain, info, loading_msg)
 
         except Exception as e:
             logging.error(f"Error handling URL: {e}")
@@ -458,9 +1052,10 @@ class TelegramBot:
                 parse_mode=ParseMode.HTML
             )
 
-    async def show_video_options(self, update: Update, url: str, info: Dict, loading_msg):
+    async def show_video_options(self, update: Update, url: str, domain: str,
+                                 info: Dict, loading_msg):
         """عرض خيارات الفيديو"""
-        title = info.get('title', 'Unknown Title')[:50]
+        title = html.escape(info.get('title', 'Unknown Title')[:50])
         duration = info.get('duration', 0)
         duration_str = f"{duration//60}:{duration%60:02d}" if duration else "غير محدد"
 
@@ -468,23 +1063,31 @@ class TelegramBot:
 🎬 <b>{title}</b>
 
 ⏱️ <b>المدة:</b> {duration_str}
-🌐 <b>المنصة:</b> {urlparse(url).netloc}
+🌐 <b>المنصة:</b> {domain}
 
 <b>اختر طريقة التحميل:</b>
         """
 
+        # رمز قصير وعشوائي يربط الأزرار بهذه الجلسة بدلاً من hash(url)
+        token = secrets.token_urlsafe(6)
         keyboard = [
-            [InlineKeyboardButton("🎬 تحميل الفيديو", callback_data=f"video_{hash(url)}")],
-            [InlineKeyboardButton("🎵 صوت فقط", callback_data=f"audio_{hash(url)}")],
-            [InlineKeyboardButton("📝 ترجمات فقط", callback_data=f"subs_{hash(url)}")],
-            [InlineKeyboardButton("❌ إلغاء", callback_data="cancel")]
+            [InlineKeyboardButton("🎬 تحميل الفيديو", callback_data=f"video_{token}")],
+            [InlineKeyboardButton("🎵 صوت فقط", callback_data=f"audio_{token}")],
+            [InlineKeyboardButton("📝 ترجمات فقط", callback_data=f"subs_{token}")],
+            [InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel_{token}")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
-        self.user_states[update.effective_user.id] = {
+        self.sessions[token] = {
+            'user_id': update.effective_user.id,
             'url': url,
-            'info': info
+            'domain': domain,
+            'platform': self._platform_key(domain, info),
+            'info': info,
+            'token': token,
+            'created': time.monotonic()
         }
+        self._evict_sessions()
 
         await loading_msg.edit_text(
             info_text,
@@ -492,6 +1095,81 @@ class TelegramBot:
             reply_markup=reply_markup
         )
 
+    @asynccontextmanager
+    async def _progress_pump(self, progress_msg, header: str):
+        """عرض تقدم التحميل من مهمة واحدة تقرأ آخر حالة كل PROGRESS_INTERVAL ثانية"""
+        state = {'percent': None}
+
+        def report(d):
+            # يُستدعى من خيط التحميل: حفظ آخر نسبة فقط دون أي استدعاء لـ Telegram
+            if d.get('status') == 'downloading':
+                total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                if total:
+                    state['percent'] = d.get('downloaded_bytes', 0) * 100.0 / total
+
+        async def pump():
+            shown = None
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                if state['percent'] is None:
+                    continue
+                percent = f"{state['percent']:.1f}%"
+                if percent == shown:
+                    continue
+                try:
+                    await progress_msg.edit_text(
+                        PROGRESS_TEXT.format(header=header, percent=percent),
+                        parse_mode=ParseMode.HTML
+                    )
+                    shown = percent
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                except BadRequest as e:
+                    # مثل "message is not modified": لا داعي لإيقاف التحميل
+                    logging.debug(f"Progress edit skipped: {e}")
+
+        task = asyncio.create_task(pump())
+        try:
+            yield report
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _evict_sessions(self):
+        """حذف الجلسات المنتهية والزائدة عن الحد (الأقدم في البداية دائماً)"""
+        deadline = time.monotonic() - self.config.session_ttl
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if oldest['created'] >= deadline and len(self.sessions) <= self.config.max_sessions:
+                break
+            self.sessions.popitem(last=False)
+
+    def get_session(self, query) -> Optional[Dict]:
+        """جلب الجلسة المرتبطة بالزر إذا كانت تخص نفس المستخدم"""
+        token = query.data.partition('_')[2]
+        user_data = self.sessions.get(token)
+        if user_data is None or user_data['user_id'] != query.from_user.id:
+            return None
+        if time.monotonic() - user_data['created'] > self.config.session_ttl:
+            del self.sessions[token]
+            return None
+        return user_data
+
+    @asynccontextmanager
+    async def _chat_turn(self, chat_id: int):
+        """تنفيذ تحميلات المحادثة الواحدة بالترتيب دون حجب المحادثات الأخرى"""
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat_id]
+
     async def callback_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالج الأزرار التفاعلية"""
         query = update.callback_query
@@ -506,50 +1184,66 @@ class TelegramBot:
             await self.show_stats_callback(query)
         elif data == "back_main":
             await self.back_to_main(query)
-        elif data == "cancel":
+        elif data.startswith("cancel"):
             await self.cancel_operation(query)
         elif data.startswith("video_"):
-            await self.download_video_callback(query)
+            async with self._chat_turn(query.message.chat_id):
+                await self.download_video_callback(query)
         elif data.startswith("audio_"):
-            await self.download_audio_callback(query)
+            async with self._chat_turn(query.message.chat_id):
+                await self.download_audio_callback(query)
         elif data.startswith("subs_"):
-            await self.download_subtitles_callback(query)
+            async with self._chat_turn(query.message.chat_id):
+                await self.download_subtitles_callback(query)
 
     async def download_video_callback(self, query):
         """معالجة تحميل الفيديو"""
         user_id = query.from_user.id
+        user_data = self.get_session(query)
 
-        if user_id not in self.user_states:
+        if user_data is None:
             await query.edit_message_text(
                 "❌ انتهت صلاحية الجلسة. أرسل الرابط مرة أخرى.",
                 parse_mode=ParseMode.HTML
             )
             return
 
-        user_data = self.user_states[user_id]
         url = user_data['url']
 
         progress_msg = await query.edit_message_text(
             "🚀 <b>بدء التحميل...</b>",
             parse_mode=ParseMode.HTML
         )
+        downloaded_file = None
+        file_size = 0
+        cache_key = self._file_cache_key('video', user_data['info'])
 
         try:
-            success, result, info = await self.downloader.download_video(url)
+            cached = await self._cached_file(cache_key)
+            if cached:
+                success, result, info = True, cached, user_data['info']
+            else:
+                async with self._progress_pump(progress_msg, "📥 <b>جاري التحميل...</b>") as report:
+                    success, result, info = await self._shared_download(
+                        cache_key, lambda: self.downloader.download_video(
+                            url, user_data['platform'], progress_callback=report,
+                            cached_info=user_data['info']
+                        )
+                    )
 
             if success:
-                file_size = os.path.getsize(result) if os.path.exists(result) else 0
-                self.db.log_download(
+                downloaded_file = result
+                self._file_users[result] += 1
+                file_size = await asyncio.to_thread(self._file_size, result)
+                await self.db.log_download(
                     user_id, url, info.get('title', 'Unknown'),
-                    urlparse(url).netloc, file_size, 'completed'
+                    user_data['domain'], file_size, 'completed'
                 )
 
                 if file_size < self.config.max_file_size * 1024 * 1024:
-                    with open(result, 'rb') as video_file:
-                        await query.message.reply_document(
-                            video_file,
-                            caption=f"🎬 {info.get('title', 'فيديو')}"
-                        )
+                    await self._send_document(
+                        query.message, result, f"🎬 {info.get('title', 'فيديو')}"
+                    )
                     await progress_msg.edit_text(
                         "✅ <b>تم التحميل بنجاح!</b>",
                         parse_mode=ParseMode.HTML
@@ -561,60 +1255,76 @@ class TelegramBot:
                         parse_mode=ParseMode.HTML
                     )
             else:
-                self.db.log_download(
+                await self.db.log_download(
                     user_id, url, user_data['info'].get('title', 'Unknown'),
-                    urlparse(url).netloc, 0, 'failed', result
+                    user_data['domain'], 0, 'failed', result
                 )
                 await progress_msg.edit_text(
-                    f"❌ <b>فشل التحميل</b>\n\n{result}",
+                    ERROR_TEXT.format(title="فشل التحميل", details=html.escape(result)),
                     parse_mode=ParseMode.HTML
                 )
 
         except Exception as e:
             logging.error(f"Download error: {e}")
             await progress_msg.edit_text(
-                f"❌ <b>خطأ في التحميل</b>\n\n{str(e)}",
+                ERROR_TEXT.format(title="خطأ في التحميل", details=html.escape(str(e))),
                 parse_mode=ParseMode.HTML
             )
-
-        if user_id in self.user_states:
-            del self.user_states[user_id]
+        finally:
+            # تنفيذ التنظيف حتى إن فشل إرسال رسالة الخطأ نفسها
+            if (downloaded_file and self._release_file(downloaded_file)
+                    and not self._keep_file(cache_key, downloaded_file, file_size)):
+                self._schedule_cleanup(downloaded_file)
+            self.sessions.pop(user_data['token'], None)
 
     async def download_audio_callback(self, query):
         """معالجة تحميل الصوت فقط"""
         user_id = query.from_user.id
+        user_data = self.get_session(query)
 
-        if user_id not in self.user_states:
+        if user_data is None:
             await query.edit_message_text(
                 "❌ انتهت صلاحية الجلسة. أرسل الرابط مرة أخرى.",
                 parse_mode=ParseMode.HTML
             )
             return
 
-        user_data = self.user_states[user_id]
         url = user_data['url']
 
         progress_msg = await query.edit_message_text(
             "🎵 <b>جاري تحميل الصوت...</b>",
             parse_mode=ParseMode.HTML
         )
+        downloaded_file = None
+        file_size = 0
+        cache_key = self._file_cache_key('audio', user_data['info'])
 
         try:
-            success, result, info = await self.downloader.download_audio_only(url)
+            cached = await self._cached_file(cache_key)
+            if cached:
+                success, result, info = True, cached, user_data['info']
+            else:
+                async with self._progress_pump(progress_msg, "🎵 <b>جاري تحميل الصوت...</b>") as report:
+                    success, result, info = await self._shared_download(
+                        cache_key, lambda: self.downloader.download_audio_only(
+                            url, user_data['platform'], progress_callback=report,
+                            cached_info=user_data['info']
+                        )
+                    )
 
             if success:
-                file_size = os.path.getsize(result) if os.path.exists(result) else 0
-                self.db.log_download(
+                downloaded_file = result
+                self._file_users[result] += 1
+                file_size = await asyncio.to_thread(self._file_size, result)
+                await self.db.log_download(
                     user_id, url, info.get('title', 'Unknown'),
-                    urlparse(url).netloc, file_size, 'completed'
+                    user_data['domain'], file_size, 'completed'
                 )
 
                 if file_size < self.config.max_file_size * 1024 * 1024:
-                    with open(result, 'rb') as audio_file:
-                        await query.message.reply_document(
-                            audio_file,
-                            caption=f"🎵 {info.get('title', 'صوت')}"
-                        )
+                    await self._send_document(
+                        query.message, result, f"🎵 {info.get('title', 'صوت')}"
+                    )
                     await progress_msg.edit_text(
                         "✅ <b>تم تحميل الصوت بنجاح!</b>",
                         parse_mode=ParseMode.HTML
@@ -626,37 +1336,39 @@ class TelegramBot:
                         parse_mode=ParseMode.HTML
                     )
             else:
-                self.db.log_download(
+                await self.db.log_download(
                     user_id, url, user_data['info'].get('title', 'Unknown'),
-                    urlparse(url).netloc, 0, 'failed', result
+                    user_data['domain'], 0, 'failed', result
                 )
                 await progress_msg.edit_text(
-                    f"❌ <b>فشل تحميل الصوت</b>\n\n{result}",
+                    ERROR_TEXT.format(title="فشل تحميل الصوت", details=html.escape(result)),
                     parse_mode=ParseMode.HTML
                 )
 
         except Exception as e:
             logging.error(f"Audio download error: {e}")
             await progress_msg.edit_text(
-                f"❌ <b>خطأ في تحميل الصوت</b>\n\n{str(e)}",
+                ERROR_TEXT.format(title="خطأ في تحميل الصوت", details=html.escape(str(e))),
                 parse_mode=ParseMode.HTML
             )
-
-        if user_id in self.user_states:
-            del self.user_states[user_id]
+        finally:
+            # تنفيذ التنظيف حتى إن فشل إرسال رسالة الخطأ نفسها
+            if (downloaded_file and self._release_file(downloaded_file)
+                    and not self._keep_file(cache_key, downloaded_file, file_size)):
+                self._schedule_cleanup(downloaded_file)
+            self.sessions.pop(user_data['token'], None)
 
     async def download_subtitles_callback(self, query):
         """معالجة تحميل الترجمات فقط"""
-        user_id = query.from_user.id
+        user_data = self.get_session(query)
 
-        if user_id not in self.user_states:
+        if user_data is None:
             await query.edit_message_text(
                 "❌ انتهت صلاحية الجلسة. أرسل الرابط مرة أخرى.",
                 parse_mode=ParseMode.HTML
             )
             return
 
-        user_data = self.user_states[user_id]
         url = user_data['url']
 
         progress_msg = await query.edit_message_text(
@@ -664,8 +1376,12 @@ class TelegramBot:
             parse_mode=ParseMode.HTML
         )
 
+        subtitle_files = {}
+
         try:
-            subtitle_files = await self.downloader.extract_subtitles(url, ['ar', 'en'])
+            subtitle_files = await self.downloader.extract_subtitles(
+                url, user_data['platform'], ['ar', 'en']
+            )
 
             if subtitle_files:
                 await progress_msg.edit_text(
@@ -673,13 +1389,10 @@ class TelegramBot:
                     parse_mode=ParseMode.HTML
                 )
 
-                for lang, filepath in subtitle_files.items():
-                    if os.path.exists(filepath):
-                        with open(filepath, 'rb') as sub_file:
-                            await query.message.reply_document(
-                                sub_file,
-                                caption=f"📝 ترجمة {lang.upper()}"
-                            )
+                await self._send_documents(query.message, [
+                    (filepath, f"📝 ترجمة {lang.upper()}")
+                    for lang, filepath in subtitle_files.items()
+                ])
             else:
                 await progress_msg.edit_text(
                     "❌ <b>لم يتم العثور على ترجمات</b>",
@@ -689,117 +1402,59 @@ class TelegramBot:
         except Exception as e:
             logging.error(f"Subtitle extraction error: {e}")
             await progress_msg.edit_text(
-                f"❌ <b>خطأ في استخراج الترجمات</b>\n\n{str(e)}",
+                ERROR_TEXT.format(title="خطأ في استخراج الترجمات", details=html.escape(str(e))),
                 parse_mode=ParseMode.HTML
             )
-
-        if user_id in self.user_states:
-            del self.user_states[user_id]
+        finally:
+            if subtitle_files:
+                # كل الترجمات في مجلد الطلب نفسه
+                self._schedule_cleanup(os.path.dirname(next(iter(subtitle_files.values()))))
+            self.sessions.pop(user_data['token'], None)
 
     async def show_help_callback(self, query):
         """عرض المساعدة في الوضع التفاعلي"""
-        help_text = """
-📚 <b>دليل الاستخدام</b>
-
-• أرسل رابط أي فيديو من المنصات المدعومة
-• اختر نوع التحميل المطلوب
-• انتظر حتى اكتمال التحميل
-• استلم الملف عبر البوت
-
-🔧 <b>الأوامر المتاحة:</b>
-/start - بدء استخدام البوت
-/help - عرض المساعدة
-/stats - عرض الإحصائيات
-/cancel - إلغاء العملية الحالية
-        """
-
-        keyboard = [
-            [InlineKeyboardButton("🔙 العودة", callback_data="back_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
         await query.edit_message_text(
-            help_text,
+            HELP_CALLBACK_TEXT,
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=BACK_KEYBOARD
         )
 
     async def show_stats_callback(self, query):
         """إظهار الإحصائيات"""
-        user_id = query.from_user.id
-
-        with sqlite3.connect(self.db.db_path) as conn:
-            cursor = conn.execute("""
-                SELECT downloads_count, joined_date FROM users WHERE user_id = ?
-            """, (user_id,))
-            user_data = cursor.fetchone()
-
-            cursor = conn.execute("""
-                SELECT COUNT(*) as total, 
-                       SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as completed
-                FROM downloads WHERE user_id = ?
-            """, (user_id,))
-            download_stats = cursor.fetchone()
-
-        if user_data:
-            downloads_count, joined_date = user_data
-            join_date = datetime.fromisoformat(joined_date).strftime('%Y-%m-%d')
-        else:
-            downloads_count, join_date = 0, "غير متاح"
+        downloads_count, joined_date, total_attempts, completed = \
+            await self.db.get_user_stats(query.from_user.id)
 
-        if download_stats:
-            total_attempts, completed = download_stats
-            success_rate = (completed / total_attempts * 100) if total_attempts > 0 else 0
-        else:
-            total_attempts = completed = success_rate = 0
-
-        stats_text = f"""
-📊 <b>إحصائياتك الشخصية</b>
-
-• تاريخ الانضمام: {join_date}
-• إجمالي التحميلات: {downloads_count}
-• المحاولات الكلية: {total_attempts}
-• النجح: {completed}
-• معدل النجاح: {success_rate:.1f}%
-        """
-
-        keyboard = [
-            [InlineKeyboardButton("🔙 العودة", callback_data="back_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        join_date = self._format_date(joined_date) if joined_date is not None else "غير متاح"
+        downloads_count = downloads_count or 0
+        total_attempts = total_attempts or 0
+        completed = completed or 0
+        success_rate = (completed / total_attempts * 100) if total_attempts > 0 else 0
 
         await query.edit_message_text(
-            stats_text,
+            STATS_TEXT.format(
+                join_date=join_date,
+                downloads_count=downloads_count,
+                total_attempts=total_attempts,
+                completed=completed,
+                success_rate=success_rate
+            ),
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=BACK_KEYBOARD
         )
 
     async def back_to_main(self, query):
         """العودة إلى القائمة الرئيسية"""
-        user = query.from_user
-        welcome_text = f"""
-🎥 <b>مرحباً بعودتك {user.first_name}!</b>
-
-اختر أحد الخيارات:
-        """
-
-        keyboard = [
-            [InlineKeyboardButton("📋 المساعدة", callback_data="help"),
-             InlineKeyboardButton("📊 الإحصائيات", callback_data="stats")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
         await query.edit_message_text(
-            welcome_text,
+            WELCOME_BACK_TEXT.format(first_name=html.escape(query.from_user.first_name)),
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=MAIN_MENU_KEYBOARD
         )
 
     async def cancel_operation(self, query):
         """إلغاء العملية الحالية"""
-        user_id = query.from_user.id
-        if user_id in self.user_states:
-            del self.user_states[user_id]
+        user_data = self.get_session(query)
+        if user_data is not None:
+            del self.sessions[user_data['token']]
 
         await query.edit_message_text(
             "❌ <b>تم إلغاء العملية</b>\n\n"
@@ -816,7 +1471,7 @@ class TelegramBot:
             )
             return
 
-        playlist_title = info.get('title', 'قائمة تشغيل')
+        playlist_title = html.escape(info.get('title', 'قائمة تشغيل'))
         entries_count = len(info['entries'])
 
         info_text = f"""
@@ -833,9 +1488,53 @@ class TelegramBot:
             parse_mode=ParseMode.HTML
         )
 
+    async def post_init(self, application: Application):
+        """تهيئة ما يحتاج حلقة أحداث قبل استقبال التحديثات"""
+        # المنفذ الافتراضي يخدم asyncio.to_thread للتحميل وقاعدة البيانات والملفات؛
+        # الحجم الافتراضي min(32, cpu+4) صغير جداً لعمل ينتظر الشبكة أغلب الوقت
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+            max_workers=max(32, self.config.max_concurrent_downloads * 4),
+            thread_name_prefix='ytdlp'
+        ))
+        self._log_writer = asyncio.create_task(self.db.run_log_writer())
+        self._rate_snapshot = asyncio.create_task(self.db.run_rate_snapshot())
+
+    async def post_shutdown(self, application: Application):
+        """حفظ العدادات والسجلات المتبقية وإغلاق قاعدة البيانات عند الإيقاف"""
+        if self._rate_snapshot is not None:
+            self._rate_snapshot.cancel()
+            await asyncio.gather(self._rate_snapshot, return_exceptions=True)
+            await self.db.save_rate_limits()
+        if self._log_writer is not None:
+            self.db.stop_log_writer()
+            await self._log_writer
+        # الملفات المخزنة لا يمكن الرجوع إليها بعد إعادة التشغيل
+        cached_paths = [path for path, _ in self._file_cache.values()]
+        self._file_cache.clear()
+        await asyncio.gather(*(asyncio.to_thread(self._remove_file, path) for path in cached_paths))
+        self.db.close()
+        self.downloader.close()
+
     def run(self):
         """تشغيل البوت"""
-        application = Application.builder().token(self.config.bot_token).build()
+        builder = (
+            Application.builder()
+            .token(self.config.bot_token)
+            # معالجة التحديثات بالتوازي: تحميل طويل لا يؤخر أزرار المستخدمين الآخرين؛
+            # لا يُستخدم block=False لأنه يحرر مكان التحديث قبل انتهاء المعالج فيلغي هذا الحد
+            .concurrent_updates(self.config.max_concurrent_updates)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+        )
+        if self.config.bot_api_url:
+            # يجب أن يصل الخادم المحلي إلى مجلد التحميل بنفس المسارات
+            builder = (
+                builder
+                .base_url(f"{self.config.bot_api_url}/bot")
+                .base_file_url(f"{self.config.bot_api_url}/file/bot")
+                .local_mode(True)
+            )
+        application = builder.build()
 
         # معالجات الأوامر
         application.add_handler(CommandHandler("start", self.start_command))
@@ -843,25 +1542,47 @@ class TelegramBot:
         application.add_handler(CommandHandler("stats", self.show_stats_callback))
         application.add_handler(CommandHandler("cancel", self.cancel_operation))
 
-        # معالج الروابط
+        # معالج الروابط: الرسائل التي لا تبدأ برابط لا تصل إلى handle_url أصلاً
         application.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND, 
+            filters.TEXT & filters.Regex(re.compile(r'^\s*https?://\S', re.IGNORECASE)),
             self.handle_url
         ))
+        # باقي النصوص تحصل على قائمة المنصات المدعومة دون فحص المعدل أو التحليل
+        application.add_handler(MessageHandler(
+            filters.TEXT & ~filters.COMMAND,
+            self.handle_unsupported
+        ))
 
         # معالج الأزرار
         application.add_handler(CallbackQueryHandler(self.callback_handler))
 
         print("🚀 البوت جاهز للعمل!")
-        application.run_polling()
-
-# إعداد التسجيل
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+        if self.config.webhook_url:
+            application.run_webhook(
+                listen='0.0.0.0',
+                port=self.config.webhook_port,
+                # المسار المحلي يطابق مسار الرابط العام المسجل لدى Telegram
+                url_path=urlparse(self.config.webhook_url).path.lstrip('/'),
+                webhook_url=self.config.webhook_url,
+                secret_token=self.config.webhook_secret or None
+            )
+        else:
+            application.run_polling()
 
 if __name__ == "__main__":
+    # إعداد التسجيل: الاستدعاءات تضع السجل في طابور فقط، والكتابة الفعلية في خيط منفصل
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    )
+    log_listener = QueueListener(log_queue, stream_handler)
+    queue_handler = QueueHandler(log_queue)
+    # التنسيق الكامل يتم في خيط الكتابة؛ هنا نص الرسالة فقط
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    log_listener.start()
+
     config = BotConfig()
 
     if not config.bot_token:
@@ -876,4 +1597,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("\n👋 إيقاف البوت...")
     except Exception as e:
-        logging.error(f"خطأ في تشغيل البوت: {e}")
\ No newline at end of file
+        logging.error(f"خطأ في تشغيل البوت: {e}")
+    finally:
+        log_listener.stop()
\ No newline at end of file